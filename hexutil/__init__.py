@@ -6,15 +6,18 @@ If you need it to be aligned with the y-axis instead, you will have to
 swap x and y coordinates everywhere.
 """
 
+from array import array
 from collections import namedtuple
 from heapq import heappush, heappop
 import operator
 import math
-import random
 
 class InvalidHex(ValueError):
     pass
 
+def _unit_cost(pos):
+    return 1
+
 class Hex(namedtuple("Hex", "x y")):
     "A single hexagon in a hexagonal grid."""
     _neighbours = ((2, 0), (1, 1), (-1, 1), (-2, 0), (-1, -1), (1, -1))
@@ -29,13 +32,17 @@ class Hex(namedtuple("Hex", "x y")):
         x, y = self
         return [Hex(x+dx, y+dy) for dx, dy in self._neighbours]
 
-    def random_neighbour(self, random=random):
-        """Return a random neighbour of this hexagon."""
+    def random_neighbour(self, random=None):
+        """Return a random neighbour of this hexagon.
+        random -- source of randomness with a choice method. By default the random module.
+        """
+        if random is None:
+            import random
         x, y = self
         dx, dy = random.choice(self._neighbours)
         return Hex(x+dx, y+dy)
 
-    def random_walk(self, N, random=random):
+    def random_walk(self, N, random=None):
         """Yield random walk of length N.
         Returns a generator of length N+1 since it includes the start point.
         """
@@ -102,17 +109,20 @@ class Hex(namedtuple("Hex", "x y")):
             visible = {}
         visible[self] = all_directions
         for direction in range(6):
-            _fovtree._field_of_view(self, direction, transparent, max_distance, visible)
+            _fov_root()._field_of_view(self, direction, transparent, max_distance, visible)
         return visible
 
-    def find_path(self, destination, passable, cost=lambda pos: 1):
+    def find_path(self, destination, passable, cost=_unit_cost, workspace=None, epsilon=1.0, regions=None):
         """Perform path-finding.
         self        -- Starting position for path finding.
         destination -- Destination position for path finding.
         passable    -- Function of one position, returning True if we can move through this hex.
         cost        -- cost function for moving through a hex. Should return a value ≥ 1. By default all costs are 1.
+        workspace   -- if provided, a PathFinderWorkspace to use instead of allocating new data structures.
+        epsilon     -- weight of the heuristic. Values > 1 find a path faster, which costs at most epsilon times the optimum.
+        regions     -- if provided, a RegionIndex of passable, used to detect unreachable destinations immediately.
         """
-        pathfinder = HexPathFinder(self, destination, passable, cost)
+        pathfinder = HexPathFinder(self, destination, passable, cost, workspace, epsilon, regions=regions)
         pathfinder.run()
         return pathfinder.path
 
@@ -175,7 +185,526 @@ class _FovTree:
 
         return _cached_successors
 
-_fovtree = _FovTree(Hex(2, 0), 0, -1.0, 1.0)
+_fovtree = None
+
+def _fov_root():
+    """Return the root of the FOV tree, creating it on first use."""
+    global _fovtree
+    if _fovtree is None:
+        _fovtree = _FovTree(Hex(2, 0), 0, -1.0, 1.0)
+    return _fovtree
+
+def _flatten_fovtree(node, max_distance, nodes):
+    if node.distance > max_distance:
+        return
+    i = len(nodes)
+    nodes.append(None)
+    for succ in node.successors():
+        _flatten_fovtree(succ, max_distance, nodes)
+    nodes[i] = (node, len(nodes))
+
+_fov_table_cache = None
+
+def _fov_table(max_distance):
+    """Return the FOV tree flattened up to at least max_distance, one tuple per direction.
+    Each entry is (dx, dy, side_bitmask, distance, skip), where skip is the index
+    of the first entry after the subtree rooted at this entry.
+
+    Only the table for the largest distance requested so far is kept.
+    A walk for a smaller max_distance must skip entries with a larger distance.
+    """
+    global _fov_table_cache
+    cache = _fov_table_cache
+    if cache is not None and cache[0] >= max_distance:
+        return cache[1]
+    nodes = []
+    _flatten_fovtree(_fov_root(), max_distance, nodes)
+    table = tuple(
+            tuple((node.hexagons[direction].x, node.hexagons[direction].y,
+                1 << ((node.direction + direction) % 6), node.distance, skip)
+                for node, skip in nodes)
+            for direction in range(6))
+    _fov_table_cache = (max_distance, table)
+    return table
+
+def warm_up_fov(max_distance):
+    """Build the field-of-view data structures up to max_distance.
+    They are otherwise built on first use, which makes the first field-of-view
+    computation at a new distance slower. Call this at startup to avoid that.
+    """
+    _fov_table(max_distance)
+
+_hexagon_rows_cache = {}
+
+def _hexagon_rows(radius):
+    """Return the start index of each row of a CompactFov of the given radius.
+    The final element is the total number of hexes.
+    """
+    rows = _hexagon_rows_cache.get(radius)
+    if rows is None:
+        rows = [0]
+        for dy in range(-radius, radius + 1):
+            rows.append(rows[-1] + 2*radius + 1 - abs(dy))
+        rows = tuple(rows)
+        _hexagon_rows_cache[radius] = rows
+    return rows
+
+def _bytes_and(data1, data2):
+    n = len(data1)
+    return (int.from_bytes(data1, "little") & int.from_bytes(data2, "little")).to_bytes(n, "little")
+
+def _bytes_or(data1, data2):
+    n = len(data1)
+    return (int.from_bytes(data1, "little") | int.from_bytes(data2, "little")).to_bytes(n, "little")
+
+class CompactFov:
+    """A field-of-view result, stored compactly.
+    Instead of a dict, the side bitmasks are stored in a bytearray with one
+    entry for each hex within distance radius of origin.
+
+    It supports the read-only dict interface (get, in, [], iteration, items),
+    so it can be used wherever the result of Hex.field_of_view is used.
+    It can also be passed as the visible argument to Hex.field_of_view
+    and ArrayMap.field_of_view, provided radius ≥ max_distance:
+
+        view_set = player_pos.field_of_view(..., visible=CompactFov(player_pos, max_distance))
+
+    The & and | operators combine two CompactFov objects, even if they have
+    a different origin or radius.
+    """
+
+    def __init__(self, origin, radius, data=None):
+        """Create a new CompactFov object.
+        origin -- center Hex
+        radius -- maximum distance from origin which can be stored
+        data   -- if provided, a bytes-like object with the bitmasks. Default all 0.
+        """
+        rows = _hexagon_rows(radius)
+        if data is None:
+            data = bytearray(rows[-1])
+        else:
+            data = bytearray(data)
+            if len(data) != rows[-1]:
+                raise ValueError("data has wrong length for radius")
+        self.origin = origin
+        self.radius = radius
+        self.data = data
+        self._rows = rows
+
+    def index(self, hexagon):
+        """Return the index of hexagon in data, or None if it is too far from origin."""
+        x, y = hexagon
+        ox, oy = self.origin
+        radius = self.radius
+        dy = y - oy
+        if -radius <= dy <= radius:
+            half = 2*radius - abs(dy)
+            dx = x - ox
+            if -half <= dx <= half:
+                return self._rows[dy + radius] + ((dx + half) >> 1)
+        return None
+
+    def get(self, hexagon, default=0):
+        i = self.index(hexagon)
+        if i is None:
+            return default
+        return self.data[i] or default
+
+    def __getitem__(self, hexagon):
+        result = self.get(hexagon)
+        if not result:
+            raise KeyError(hexagon)
+        return result
+
+    def __setitem__(self, hexagon, value):
+        i = self.index(hexagon)
+        if i is None:
+            raise IndexError("hexagon outside of radius")
+        self.data[i] = value
+
+    def __contains__(self, hexagon):
+        return bool(self.get(hexagon))
+
+    def __len__(self):
+        data = self.data
+        return len(data) - data.count(0)
+
+    def items(self):
+        """Return a generator of (hexagon, bitmask) pairs for all visible hexagons."""
+        ox, oy = self.origin
+        radius = self.radius
+        data = self.data
+        i = 0
+        for dy in range(-radius, radius + 1):
+            half = 2*radius - abs(dy)
+            for dx in range(-half, half + 1, 2):
+                if data[i]:
+                    yield Hex(ox + dx, oy + dy), data[i]
+                i += 1
+
+    def keys(self):
+        """Return a generator of all visible hexagons."""
+        return (hexagon for hexagon, bitmask in self.items())
+
+    __iter__ = keys
+
+    def _blit(self, src, op):
+        """Combine the bitmasks of src into self, using op on each overlapping row."""
+        sx, sy = src.origin
+        sr = src.radius
+        dx, dy = self.origin
+        dr = self.radius
+        data = self.data
+        src_data = src.data
+        for y in range(max(sy - sr, dy - dr), min(sy + sr, dy + dr) + 1):
+            shalf = 2*sr - abs(y - sy)
+            dhalf = 2*dr - abs(y - dy)
+            slo = sx - shalf
+            dlo = dx - dhalf
+            lo = max(slo, dlo)
+            hi = min(sx + shalf, dx + dhalf)
+            if lo > hi:
+                continue
+            n = ((hi - lo) >> 1) + 1
+            s = src._rows[y - sy + sr] + ((lo - slo) >> 1)
+            d = self._rows[y - dy + dr] + ((lo - dlo) >> 1)
+            data[d:d+n] = op(data[d:d+n], src_data[s:s+n])
+
+    def __and__(self, other):
+        if not isinstance(other, CompactFov):
+            return NotImplemented
+        if self.origin == other.origin and self.radius == other.radius:
+            return CompactFov(self.origin, self.radius, _bytes_and(self.data, other.data))
+        result = CompactFov(self.origin, self.radius)
+        result._blit(other, _bytes_or)
+        result._blit(self, _bytes_and)
+        return result
+
+    def __or__(self, other):
+        if not isinstance(other, CompactFov):
+            return NotImplemented
+        if self.origin == other.origin and self.radius == other.radius:
+            return CompactFov(self.origin, self.radius, _bytes_or(self.data, other.data))
+        radius = max(self.radius, other.radius + self.origin.distance(other.origin))
+        result = CompactFov(self.origin, radius)
+        result._blit(self, _bytes_or)
+        result._blit(other, _bytes_or)
+        return result
+
+class ArrayMap:
+    """A rectangular map of hexagons, densely stored in a bytearray.
+    Hex (x, y) is stored at index y*width + x//2, for 0 ≤ y < height and 0 ≤ x < 2*width.
+    Hexes outside the map have value 0.
+
+    An ArrayMap is callable, so it can be passed directly as the transparent
+    or passable function elsewhere in this module.
+    """
+
+    def __init__(self, width, height, data=None):
+        """Create a new ArrayMap object.
+        width  -- number of hexes per row
+        height -- number of rows
+        data   -- if provided, a bytes-like object of length width*height. Default all 0.
+        """
+        size = width * height
+        if data is None:
+            data = bytearray(size)
+        else:
+            data = bytearray(data)
+            if len(data) != size:
+                raise ValueError("data must have length width*height")
+        self.width = width
+        self.height = height
+        self.data = data
+
+    @classmethod
+    def from_function(cls, width, height, func):
+        """Create an ArrayMap by calling func on every hex of the map."""
+        result = cls(width, height)
+        data = result.data
+        for hexagon in result.hexagons():
+            data[result.index(hexagon)] = 1 if func(hexagon) else 0
+        return result
+
+    def hexagons(self):
+        """Return a generator of all hexes in the map."""
+        width = 2 * self.width
+        return (Hex(x, y) for y in range(self.height) for x in range(y & 1, width, 2))
+
+    def index(self, hexagon):
+        """Return the index of hexagon in data, or None if it is outside the map."""
+        x, y = hexagon
+        if 0 <= y < self.height and 0 <= x < 2 * self.width:
+            return y * self.width + (x >> 1)
+        return None
+
+    def __getitem__(self, hexagon):
+        i = self.index(hexagon)
+        return 0 if i is None else self.data[i]
+
+    def __setitem__(self, hexagon, value):
+        i = self.index(hexagon)
+        if i is None:
+            raise IndexError("hexagon outside of map")
+        self.data[i] = value
+
+    def __call__(self, hexagon):
+        return bool(self[hexagon])
+
+    def field_of_view(self, origin, max_distance, visible=None):
+        """Calculate field-of-view, using this map as the transparency map.
+        Same as origin.field_of_view(self, max_distance, visible), but walks a
+        precomputed flat copy of the FOV tree instead of calling a Python
+        function per hex.
+        If visible is a CompactFov around origin with radius max_distance,
+        it is filled without creating any Hex objects.
+        """
+        if visible is None:
+            visible = {}
+        elif (isinstance(visible, CompactFov) and visible.origin == origin
+                and visible.radius == max_distance):
+            return self._compact_field_of_view(origin, max_distance, visible)
+        ox, oy = origin
+        width = self.width
+        height = self.height
+        xlimit = 2 * width
+        data = self.data
+        visible[origin] = all_directions
+        for nodes in _fov_table(max_distance):
+            i = 0
+            n = len(nodes)
+            while i < n:
+                dx, dy, directions, distance, skip = nodes[i]
+                if distance > max_distance:
+                    i = skip
+                    continue
+                x = ox + dx
+                y = oy + dy
+                # origin is valid and table offsets are valid hexes, so skip the parity check
+                hexagon = tuple.__new__(Hex, (x, y))
+                if 0 <= y < height and 0 <= x < xlimit and data[y * width + (x >> 1)]:
+                    visible[hexagon] = all_directions
+                    i += 1
+                else:
+                    visible[hexagon] = directions | visible.get(hexagon, 0)
+                    i = skip
+        return visible
+
+    def _new_compact_field_of_view(self, origin, max_distance):
+        return self._compact_field_of_view(origin, max_distance, CompactFov(origin, max_distance))
+
+    def _compact_field_of_view(self, origin, max_distance, visible):
+        ox, oy = origin
+        width = self.width
+        height = self.height
+        xlimit = 2 * width
+        data = self.data
+        result = visible.data
+        result[visible.index(origin)] = all_directions
+        # The index of (dx, dy) in result is row_bases[dy + max_distance] + (dx >> 1).
+        rows = visible._rows
+        row_bases = [rows[dy + max_distance] + (2*max_distance - abs(dy) + 1) // 2
+                for dy in range(-max_distance, max_distance + 1)]
+        for nodes in _fov_table(max_distance):
+            i = 0
+            n = len(nodes)
+            while i < n:
+                dx, dy, directions, distance, skip = nodes[i]
+                if distance > max_distance:
+                    i = skip
+                    continue
+                compact_index = row_bases[dy + max_distance] + (dx >> 1)
+                x = ox + dx
+                y = oy + dy
+                if 0 <= y < height and 0 <= x < xlimit and data[y * width + (x >> 1)]:
+                    result[compact_index] = all_directions
+                    i += 1
+                else:
+                    result[compact_index] |= directions
+                    i = skip
+        return visible
+
+    def field_of_view_many(self, origins, max_distance, executor=None, compact=False, batches=None):
+        """Calculate field-of-view from each of the origins.
+        origins      -- sequence of Hex
+        max_distance -- maximum distance you can view
+        executor     -- if provided, a concurrent.futures.Executor to distribute the work
+        compact      -- if True, return CompactFov objects instead of dicts
+        batches      -- number of batches the origins are split into for the executor.
+                        By default the number of CPUs.
+
+        Returns a list of field-of-view results, in the order of origins.
+
+        The computation is pure Python and holds the GIL, so a ThreadPoolExecutor
+        only helps if the caller does other GIL-releasing work concurrently.
+        Use a ProcessPoolExecutor to scale over multiple cores. The map is
+        pickled once per batch, so use at most one batch per worker unless
+        the origins take very different amounts of work.
+        """
+        if batches is not None and batches < 1:
+            raise ValueError("batches must be at least 1")
+        origins = list(origins)
+        if executor is None:
+            return _field_of_view_batch(self, origins, max_distance, compact)
+        if batches is None:
+            import os
+            batches = os.cpu_count() or 1
+        batch_size = max(1, -(-len(origins) // batches))
+        origin_batches = [origins[i:i+batch_size] for i in range(0, len(origins), batch_size)]
+        n = len(origin_batches)
+        result = []
+        for fovs in executor.map(_field_of_view_batch, [self] * n, origin_batches,
+                [max_distance] * n, [compact] * n):
+            result.extend(fovs)
+        return result
+
+def _field_of_view_batch(amap, origins, max_distance, compact):
+    if compact:
+        return [amap._new_compact_field_of_view(origin, max_distance) for origin in origins]
+    return [amap.field_of_view(origin, max_distance) for origin in origins]
+
+_mask_sides = tuple(tuple(side for side in range(6) if mask & (1 << side)) for mask in range(64))
+
+def linear_falloff(distance, radius):
+    """Light falloff which decreases linearly from 1 at the light source to 0 just beyond radius."""
+    return 1.0 - distance / (radius + 1.0)
+
+class _Light:
+    def __init__(self, position, radius, intensity):
+        self.position = position
+        self.radius = radius
+        self.intensity = intensity
+        self.fov = None
+        self.indices = ()
+        self.values = ()
+
+class LightMap:
+    """Accumulated light intensity from many light sources on an ArrayMap of transparency.
+
+    Light is tracked per side of each hex, using the side bitmasks of field_of_view:
+    a light only lights the sides of an opaque hex which it can see.
+    Each light remembers its contribution, so when a light changes or a hex
+    changes transparency, only the affected lights are recomputed.
+    The number of contributing lights is counted per side, and a side without
+    any is reset to exactly 0, so rounding errors from removing light do not
+    leave unlit sides with a small nonzero intensity.
+    """
+
+    def __init__(self, transparent, falloff=linear_falloff):
+        """Create a new LightMap object.
+        transparent -- ArrayMap, nonzero for transparent hexes
+        falloff     -- function of distance and radius, giving the fraction of the intensity at that distance
+        """
+        self.transparent = transparent
+        self.falloff = falloff
+        size = 6 * transparent.width * transparent.height
+        self.light = array("d", [0.0]) * size
+        self._counts = array("L", [0]) * size
+        self._lights = {}
+        self._dirty = set()
+        self._next_id = 0
+
+    def add_light(self, position, radius, intensity=1.0):
+        """Add a light source, and return its id."""
+        light_id = self._next_id
+        self._next_id += 1
+        self._lights[light_id] = _Light(position, radius, intensity)
+        self._dirty.add(light_id)
+        return light_id
+
+    def move_light(self, light_id, position):
+        """Move the light source with the given id."""
+        light = self._lights[light_id]
+        if light.position != position:
+            light.position = position
+            self._dirty.add(light_id)
+
+    def remove_light(self, light_id):
+        """Remove the light source with the given id."""
+        light = self._lights.pop(light_id)
+        self._dirty.discard(light_id)
+        self._subtract(light)
+
+    def set_transparent(self, hexagon, value):
+        """Change the transparency of a hex, and mark the lights which can see it for recomputation."""
+        transparent = self.transparent
+        if bool(transparent[hexagon]) == bool(value):
+            return
+        transparent[hexagon] = value
+        for light_id, light in self._lights.items():
+            if light.fov is not None and hexagon in light.fov:
+                self._dirty.add(light_id)
+
+    def _subtract(self, light):
+        result = self.light
+        counts = self._counts
+        for i, value in zip(light.indices, light.values):
+            count = counts[i] - 1
+            counts[i] = count
+            if count:
+                result[i] -= value
+            else:
+                result[i] = 0.0
+        light.fov = None
+        light.indices = light.values = ()
+
+    def _add(self, light):
+        transparent = self.transparent
+        position = light.position
+        radius = light.radius
+        intensity = light.intensity
+        falloff = self.falloff
+        result = self.light
+        counts = self._counts
+        light.fov = transparent.field_of_view(position, radius, CompactFov(position, radius))
+        indices = array("l")
+        values = array("d")
+        for hexagon, mask in light.fov.items():
+            index = transparent.index(hexagon)
+            if index is None:
+                continue
+            value = intensity * falloff(position.distance(hexagon), radius)
+            for side in _mask_sides[mask]:
+                i = 6 * index + side
+                result[i] += value
+                counts[i] += 1
+                indices.append(i)
+                values.append(value)
+        light.indices = indices
+        light.values = values
+
+    def update(self):
+        """Recompute the lights which have changed. This is done automatically when querying."""
+        lights = self._lights
+        for light_id in self._dirty:
+            light = lights[light_id]
+            self._subtract(light)
+            self._add(light)
+        self._dirty.clear()
+
+    def intensity(self, hexagon, sides=all_directions):
+        """Return the light intensity on the given sides of hexagon.
+        sides -- side bitmask, e.g. from the viewer's field_of_view. The brightest side is returned.
+        """
+        if self._dirty:
+            self.update()
+        index = self.transparent.index(hexagon)
+        if index is None:
+            return 0.0
+        light = self.light
+        result = 0.0
+        for side in _mask_sides[sides]:
+            result = max(result, light[6 * index + side])
+        return result
+
+    def intensities(self):
+        """Return an array with, for each hex of the map, the intensity of its brightest side.
+        The array is indexed like ArrayMap.data.
+        """
+        if self._dirty:
+            self.update()
+        light = self.light
+        return array("d", [max(0.0, max(light[i:i+6])) for i in range(0, len(light), 6)])
 
 class Rectangle(namedtuple("Rectangle", "x y width height")):
     """Represents a rectangle.
@@ -263,29 +792,100 @@ class HexPathFinder:
     """A* path-finding on the hex grid.
     All positions are represented as Hex objects.
 
+    With epsilon > 1, this is weighted A*: the heuristic is multiplied by epsilon,
+    which typically finds a path with fewer steps, at a cost of at most epsilon times the optimum.
+
+    In anytime mode, a weighted search is restarted with epsilon lowered by epsilon_step
+    each time it finishes, until a search with epsilon 1 has finished.
+    Every restarted search only looks for paths cheaper than the best path found so far.
+    So the first path is found quickly and then improved while run_n keeps being called,
+    until the path is optimal.
+
     Important data attributes: 
-    found -- True if path-finding is complete and we found a path
-    done  -- True if path-finding is complete: we either found a path or know there isn't one
-    path  -- The path, as a tuple of positions from start to destination (including both). Empty tuple if found is False.
+    found     -- True if we found a path. In anytime mode, path-finding may continue to improve it.
+    done      -- True if path-finding is complete: we either found the final path or know there isn't one
+    path      -- The best path found so far, as a list of positions from start to destination (including both). None if found is False.
+    path_cost -- The cost of path. None if found is False.
+    epsilon   -- The weight of the heuristic in the current search.
     """
 
     found = False
     done = False
     path = None
+    path_cost = None
     
-    def __init__(self, start, destination, passable, cost=lambda pos: 1):
+    def __init__(self, start, destination, passable, cost=_unit_cost, workspace=None,
+            epsilon=1.0, anytime=False, epsilon_step=0.5, regions=None):
         """Create a new HexPathFinder object.
         start       -- Starting position for path finding.
         destination -- Destination position for path finding.
         passable    -- Function of one position, returning True if we can move through this hex.
         cost        -- cost function for moving through a hex. Should return a value ≥ 1. By default all costs are 1.
+        workspace   -- if provided, a PathFinderWorkspace to use instead of allocating new data structures.
+                       It is reset, so it must not be in use by another HexPathFinder.
+        epsilon     -- weight of the heuristic, ≥ 1. By default 1, which finds an optimal path.
+        anytime     -- if True, keep improving the path until it is optimal.
+        epsilon_step -- in anytime mode, how much to lower epsilon for each restarted search.
+        regions     -- if provided, a RegionIndex of the same passability as passable.
+                       If it shows that destination cannot be reached, we are done immediately.
         """
+        if epsilon < 1.0:
+            raise ValueError("epsilon must be at least 1")
+        if anytime and epsilon_step <= 0:
+            raise ValueError("epsilon_step must be positive")
         self.start = start
         self.destination = destination
         self.passable = passable
         self.cost = cost
-        self.closedset = set()
-        self.openset = [(self._heuristic(start), 0, start, ())]
+        self.workspace = workspace
+        self.epsilon = epsilon
+        self.anytime = anytime
+        self.epsilon_step = epsilon_step
+        if workspace is None:
+            self.openset = []
+        else:
+            self.openset = workspace.openset
+            # The start is expanded even if it lies outside the map; it then has index -1.
+            self._start_index = workspace.index(start)
+            if self._start_index is None:
+                self._start_index = -1
+            self._destination_index = workspace.index(destination)
+            if self._destination_index is None:
+                self._destination_index = self._start_index if destination == start else -2
+        if regions is not None and not regions.reachable(start, destination):
+            del self.openset[:]
+            self.done = True
+            return
+        self._start_search()
+
+    def _start_search(self):
+        start = self.start
+        if self.workspace is None:
+            self.closedset = set()
+            del self.openset[:]
+            self.openset.append((self.epsilon * self._heuristic(start), 0, start, ()))
+        else:
+            self.workspace.reset()
+            self.openset.append((self.epsilon * self._heuristic(start), 0, self._start_index))
+
+    def _end_search(self):
+        """Called when the current search has either reached the destination or exhausted the open set."""
+        del self.openset[:]
+        if self.anytime and self.epsilon > 1.0:
+            self.epsilon = max(1.0, self.epsilon - self.epsilon_step)
+            self._start_search()
+        else:
+            self.done = True
+
+    def _reached(self, path, path_cost):
+        """Called when the destination is reached.
+        path -- function without arguments which returns the path as a list
+        """
+        if self.path_cost is None or path_cost < self.path_cost:
+            self.path = path()
+            self.path_cost = path_cost
+        self.found = True
+        self._end_search()
 
     def _heuristic(self, position):
         return self.destination.distance(position)
@@ -303,36 +903,395 @@ class HexPathFinder:
         if pathfinding must be interleaved with interactive behaviour or may
         be interrupted.
          """
+        if self.done:
+            return
+        if self.workspace is not None:
+            self._run_n_workspace(n)
+            return
         openset = self.openset
         closedset = self.closedset
         passable = self.passable
         cost = self.cost
         destination = self.destination
         heuristic = self._heuristic
+        epsilon = self.epsilon
+        bound = self.path_cost
 
         for i in range(n):
             if not openset:
-                self.done = True
+                self._end_search()
                 return
             h, cur_cost, pos, path = heappop(openset)
             if pos in closedset:
                 continue
             new_path = (pos, path)
             if pos == destination:
-                self.path = self._compute_path(new_path)
-                self.found = self.done = True
-                del openset[:]
+                self._reached(lambda: self._compute_path(new_path), cur_cost)
                 return
             closedset.add(pos)
             for new_pos in pos.neighbours():
                 if (not passable(new_pos)) or (new_pos in closedset):
                     continue
                 new_cost = cur_cost + cost(new_pos)
-                new_h = new_cost + heuristic(new_pos)
+                h = heuristic(new_pos)
+                if bound is not None and new_cost + h >= bound:
+                    continue
+                new_h = new_cost + epsilon * h
                 heappush(openset, (new_h, new_cost, new_pos, new_path))
 
+    def _workspace_path(self, index):
+        width = self.workspace.width
+        parents = self.workspace.parents
+        start_index = self._start_index
+        result = []
+        while index != start_index:
+            y, k = divmod(index, width)
+            result.append(Hex(2 * k + (y & 1), y))
+            index = parents[index]
+        result.append(self.start)
+        return result[::-1]
+
+    def _run_n_workspace(self, n):
+        # The same search as run_n, but on integer indices into the arrays of the
+        # workspace, so that no Hex objects, path tuples or sets are allocated.
+        # The loops are kept separate on purpose, since sharing the inner loop would
+        # cost run_n its speed; the logic around them is shared in _start_search,
+        # _end_search and _reached. This loop always uses hex distance as heuristic.
+        # Hex objects are only created for the passable and cost functions, and not
+        # at all if passable is an ArrayMap of the size of the workspace and cost is
+        # the default.
+        workspace = self.workspace
+        openset = self.openset
+        closed = workspace.closed
+        opened = workspace.opened
+        costs = workspace.costs
+        parents = workspace.parents
+        generation = workspace.generation
+        width = workspace.width
+        height = workspace.height
+        xlimit = 2 * width
+        passable = self.passable
+        if isinstance(passable, ArrayMap) and passable.width == width and passable.height == height:
+            passable_data = passable.data
+        else:
+            passable_data = None
+        cost = self.cost
+        if cost is _unit_cost:
+            cost = None
+        start_x, start_y = self.start
+        start_index = self._start_index
+        destination_index = self._destination_index
+        tx, ty = self.destination
+        epsilon = self.epsilon
+        bound = self.path_cost
+        neighbours = Hex._neighbours
+        new_tuple = tuple.__new__
+
+        for i in range(n):
+            if not openset:
+                self._end_search()
+                return
+            f, cur_cost, index = heappop(openset)
+            if index < 0:
+                x = start_x
+                y = start_y
+            else:
+                if closed[index] == generation:
+                    continue
+                closed[index] = generation
+                y, x = divmod(index, width)
+                x = 2 * x + (y & 1)
+            if index == destination_index:
+                self._reached(lambda: self._workspace_path(index), cur_cost)
+                return
+            for dx, dy in neighbours:
+                nx = x + dx
+                ny = y + dy
+                if not (0 <= ny < height and 0 <= nx < xlimit):
+                    continue
+                new_index = ny * width + (nx >> 1)
+                if closed[new_index] == generation:
+                    continue
+                if passable_data is None:
+                    new_pos = new_tuple(Hex, (nx, ny))
+                    if not passable(new_pos):
+                        continue
+                elif not passable_data[new_index]:
+                    continue
+                if cost is None:
+                    new_cost = cur_cost + 1
+                else:
+                    new_cost = cur_cost + cost(new_tuple(Hex, (nx, ny)))
+                if opened[new_index] == generation and costs[new_index] <= new_cost:
+                    continue
+                ddx = abs(nx - tx)
+                ddy = abs(ny - ty)
+                h = ddy + ((ddx - ddy) >> 1 if ddx > ddy else 0)
+                if bound is not None and new_cost + h >= bound:
+                    continue
+                opened[new_index] = generation
+                costs[new_index] = new_cost
+                parents[new_index] = index
+                heappush(openset, (new_cost + epsilon * h, new_cost, new_index))
+
     def run(self):
         """Run path-finding until done, that is, we either found a path or know there isn't one.
         """
         while not self.done:
             self.run_n(100)
+
+
+class PathFinderWorkspace:
+    """Preallocated data structures for HexPathFinder, for a map of the given size.
+    The map is indexed like ArrayMap; hexes outside it are treated as impassable.
+
+    Instead of a closed set, the workspace has arrays which are stamped with
+    the generation number of the current query, so resetting it between
+    queries takes constant time. The best known cost and the parent of a hex
+    are only valid if its entry in opened has the current generation.
+
+    A workspace can be reused for any number of path-finding queries, but only
+    by one HexPathFinder at a time. Use a PathFinderWorkspacePool to share
+    workspaces between threads.
+    """
+
+    _max_generation = 0xffffffff
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.openset = []
+        self._allocate()
+
+    def _allocate(self):
+        size = self.width * self.height
+        self.closed = array("L", [0]) * size
+        self.opened = array("L", [0]) * size
+        self.costs = array("d", [0.0]) * size
+        self.parents = array("l", [0]) * size
+        self.generation = 0
+
+    def index(self, hexagon):
+        """Return the index of hexagon in the arrays, or None if it is outside the map."""
+        x, y = hexagon
+        if 0 <= y < self.height and 0 <= x < 2 * self.width:
+            return y * self.width + (x >> 1)
+        return None
+
+    def reset(self):
+        """Clear the workspace for a new query."""
+        if self.generation >= self._max_generation:
+            self._allocate()
+        self.generation += 1
+        del self.openset[:]
+
+class PathFinderWorkspacePool:
+    """A thread-safe pool of PathFinderWorkspace objects for a map of the given size."""
+
+    def __init__(self, width, height):
+        import threading
+        self.width = width
+        self.height = height
+        self._free = []
+        self._lock = threading.Lock()
+
+    def workspace(self):
+        """Context manager which borrows a workspace from the pool.
+
+            with pool.workspace() as workspace:
+                path = start.find_path(destination, passable, workspace=workspace)
+        """
+        # contextlib is imported here, rather than at module level, to keep "import hexutil" fast
+        import contextlib
+        return contextlib.contextmanager(self._borrow)()
+
+    def _borrow(self):
+        with self._lock:
+            workspace = self._free.pop() if self._free else None
+        if workspace is None:
+            workspace = PathFinderWorkspace(self.width, self.height)
+        try:
+            yield workspace
+        finally:
+            with self._lock:
+                self._free.append(workspace)
+
+    def find_path(self, start, destination, passable, cost=_unit_cost):
+        """Same as start.find_path(destination, passable, cost), using a workspace from the pool."""
+        with self.workspace() as workspace:
+            return start.find_path(destination, passable, cost, workspace)
+
+class RegionIndex:
+    """Labels the connected regions of passable hexes of an ArrayMap.
+    Two hexes are in the same region if you can walk from one to the other
+    over passable hexes, so reachability can be checked in constant time.
+
+    The labels are kept up to date when the map is changed through set_passable.
+    Regions which merge are joined with union-find. When a hex becomes impassable
+    and might have split its region, searches from both sides are run in lockstep;
+    if one runs out of hexes, only that part of the region is relabelled.
+    Labels are renumbered from time to time, so they should not be stored
+    across calls to set_passable.
+    """
+
+    def __init__(self, passable):
+        """Create a new RegionIndex object.
+        passable -- ArrayMap, nonzero for passable hexes
+        """
+        self.passable = passable
+        self.labels = array("L", [0]) * (passable.width * passable.height)
+        self._parent = [0]
+        labels = self.labels
+        data = passable.data
+        for x, y in passable.hexagons():
+            index = passable.index((x, y))
+            if data[index] and not labels[index]:
+                self._flood_fill(x, y, self._new_label())
+        self._compact_limit = 2 * len(self._parent) + 256
+
+    def _new_label(self):
+        label = len(self._parent)
+        self._parent.append(label)
+        return label
+
+    def _find(self, label):
+        parent = self._parent
+        while parent[label] != label:
+            parent[label] = parent[parent[label]]
+            label = parent[label]
+        return label
+
+    def _compact(self):
+        """Renumber the labels, so that every region has one label and none are unused."""
+        labels = self.labels
+        find = self._find
+        new_labels = {0: 0}
+        for index, label in enumerate(labels):
+            if label:
+                root = find(label)
+                new_label = new_labels.get(root)
+                if new_label is None:
+                    new_label = new_labels[root] = len(new_labels)
+                labels[index] = new_label
+        self._parent = list(range(len(new_labels)))
+        self._compact_limit = 2 * len(self._parent) + 256
+
+    def _flood_fill(self, x, y, label):
+        passable = self.passable
+        data = passable.data
+        width = passable.width
+        height = passable.height
+        xlimit = 2 * width
+        labels = self.labels
+        labels[y * width + (x >> 1)] = label
+        todo = [(x, y)]
+        while todo:
+            x, y = todo.pop()
+            for dx, dy in Hex._neighbours:
+                nx = x + dx
+                ny = y + dy
+                if 0 <= ny < height and 0 <= nx < xlimit:
+                    index = ny * width + (nx >> 1)
+                    if data[index] and labels[index] != label:
+                        labels[index] = label
+                        todo.append((nx, ny))
+
+    def _separated_part(self, hexagon1, hexagon2):
+        """Search from both passable hexes in lockstep, each towards the other.
+        Return None if they are connected. Otherwise, return the set of indices of
+        the region of the hex whose search ran out of hexes first.
+        """
+        passable = self.passable
+        data = passable.data
+        width = passable.width
+        height = passable.height
+        xlimit = 2 * width
+        x1, y1 = hexagon1
+        x2, y2 = hexagon2
+        visited = ({passable.index(hexagon1)}, {passable.index(hexagon2)})
+        frontiers = ([(0, x1, y1)], [(0, x2, y2)])
+        targets = (hexagon2, hexagon1)
+        while True:
+            for side in (0, 1):
+                frontier = frontiers[side]
+                if not frontier:
+                    return visited[side]
+                own = visited[side]
+                other = visited[1 - side]
+                tx, ty = targets[side]
+                h, x, y = heappop(frontier)
+                for dx, dy in Hex._neighbours:
+                    nx = x + dx
+                    ny = y + dy
+                    if 0 <= ny < height and 0 <= nx < xlimit:
+                        index = ny * width + (nx >> 1)
+                        if data[index] and index not in own:
+                            if index in other:
+                                return None
+                            own.add(index)
+                            ddx = abs(nx - tx)
+                            ddy = abs(ny - ty)
+                            heappush(frontier, (ddy + max(0, (ddx - ddy) // 2), nx, ny))
+
+    def region(self, hexagon):
+        """Return the region label of hexagon, or 0 if it is impassable."""
+        index = self.passable.index(hexagon)
+        if index is None:
+            return 0
+        label = self.labels[index]
+        return self._find(label) if label else 0
+
+    def connected(self, hexagon1, hexagon2):
+        """Return True if both hexes are passable and in the same region."""
+        region = self.region(hexagon1)
+        return region != 0 and region == self.region(hexagon2)
+
+    def reachable(self, start, destination):
+        """Return True if HexPathFinder can find a path from start to destination.
+        Like HexPathFinder, this does not require start itself to be passable.
+        """
+        if start == destination:
+            return True
+        region = self.region(destination)
+        if not region:
+            return False
+        if self.region(start) == region:
+            return True
+        return any(self.region(nb) == region for nb in start.neighbours())
+
+    def set_passable(self, hexagon, value):
+        """Change the passability of a hex in the map, and update the regions."""
+        passable = self.passable
+        was_passable = bool(passable[hexagon])
+        passable[hexagon] = value
+        if bool(value) == was_passable:
+            return
+        index = passable.index(hexagon)
+        neighbours = hexagon.neighbours()
+        if value:
+            regions = set(self.region(nb) for nb in neighbours)
+            regions.discard(0)
+            label = regions.pop() if regions else self._new_label()
+            for other in regions:
+                self._parent[other] = label
+            self.labels[index] = label
+        else:
+            self.labels[index] = 0
+            is_passable = [bool(passable[nb]) for nb in neighbours]
+            # Consecutive neighbours are adjacent to each other, so each run of
+            # passable neighbours around the hexagon stays connected.
+            # Only hexes in different runs may have been separated.
+            runs = [neighbours[i] for i in range(6) if is_passable[i] and not is_passable[i-1]]
+            labels = self.labels
+            for j in range(1, len(runs)):
+                for i in range(j):
+                    if self.region(runs[i]) != self.region(runs[j]):
+                        continue
+                    part = self._separated_part(runs[i], runs[j])
+                    if part is None:
+                        break
+                    label = self._new_label()
+                    for part_index in part:
+                        labels[part_index] = label
+        if len(self._parent) > self._compact_limit:
+            self._compact()
@@ -0,0 +1,67 @@
+"""
+asyncio variants of the path-finding and field-of-view functions in hexutil.
+
+These do the same work as their synchronous counterparts, but in bounded
+slices, yielding to the event loop in between. This keeps the loop responsive
+during long searches, and makes them cancellable: cancelling the task stops
+the computation at the next slice boundary.
+"""
+
+import asyncio
+import hexutil
+
+async def run_pathfinder(pathfinder, steps=100, executor=None):
+    """Run a HexPathFinder until done, calling pathfinder.run_n(steps) per slice.
+    executor -- if provided, run each slice in this executor (see loop.run_in_executor)
+                instead of on the event loop thread. Pass None to run slices inline.
+    """
+    loop = asyncio.get_event_loop()
+    while not pathfinder.done:
+        if executor is None:
+            pathfinder.run_n(steps)
+            await asyncio.sleep(0)
+        else:
+            await loop.run_in_executor(executor, pathfinder.run_n, steps)
+
+async def find_path(start, destination, passable, cost=hexutil._unit_cost, steps=100, executor=None,
+        workspace=None, epsilon=1.0, regions=None):
+    """Perform path-finding; async variant of Hex.find_path.
+    start       -- Starting position for path finding.
+    destination -- Destination position for path finding.
+    passable    -- Function of one position, returning True if we can move through this hex.
+    cost        -- cost function for moving through a hex. Should return a value ≥ 1. By default all costs are 1.
+    steps       -- number of path-finding steps per slice
+    executor    -- if provided, run the slices in this executor
+    workspace   -- if provided, a PathFinderWorkspace to use instead of allocating new data structures.
+                   It must not be used by another search until this one is done or cancelled.
+    epsilon     -- weight of the heuristic. Values > 1 find a path faster, which costs at most epsilon times the optimum.
+    regions     -- if provided, a RegionIndex of passable, used to detect unreachable destinations immediately.
+
+    A typical use is to cancel the previous search when a new one is started:
+
+        if self.path_task is not None:
+            self.path_task.cancel()
+        self.path_task = asyncio.ensure_future(hexutil.aio.find_path(...))
+    """
+    pathfinder = hexutil.HexPathFinder(start, destination, passable, cost, workspace, epsilon, regions=regions)
+    await run_pathfinder(pathfinder, steps, executor)
+    return pathfinder.path
+
+async def field_of_view(hexagon, transparent, max_distance, visible=None, executor=None):
+    """Calculate field-of-view; async variant of Hex.field_of_view.
+    The computation is split into 6 slices, one per direction.
+    executor -- if provided, run the slices in this executor
+    """
+    loop = asyncio.get_event_loop()
+    if visible is None:
+        visible = {}
+    visible[hexagon] = hexutil.all_directions
+    fovtree = hexutil._fov_root()
+    for direction in range(6):
+        if executor is None:
+            fovtree._field_of_view(hexagon, direction, transparent, max_distance, visible)
+            await asyncio.sleep(0)
+        else:
+            await loop.run_in_executor(executor, fovtree._field_of_view,
+                    hexagon, direction, transparent, max_distance, visible)
+    return visible
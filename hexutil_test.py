@@ -1,5 +1,11 @@
+import asyncio
+import functools
+import operator
+import random
 import unittest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import hexutil
+import hexutil.aio
 
 class HexMap(object):
     def __init__(self, str):
@@ -37,13 +43,26 @@ class HexMap(object):
     def is_passable(self, pos):
         return self.tiles.get(pos, '#') not in "#~"
 
+    def array_map(self, func):
+        width = (max(self.line_lengths) + 1) // 2
+        return hexutil.ArrayMap.from_function(width, len(self.line_lengths), func)
+
     def field_of_view(self, max_distance):
         return self.player.field_of_view(transparent=self.is_transparent, max_distance=max_distance)
 
-    def get_map(self, max_distance=None, path=frozenset()):
+    def get_map(self, max_distance=None, path=frozenset(), compact=False):
         if max_distance is not None:
-            fov = self.field_of_view(max_distance)
-            if self.lights:
+            if compact:
+                fov = self.player.field_of_view(transparent=self.is_transparent, max_distance=max_distance,
+                        visible=hexutil.CompactFov(self.player, max_distance))
+            else:
+                fov = self.field_of_view(max_distance)
+            if self.lights and compact:
+                light_fovs = [light.field_of_view(transparent=self.is_transparent, max_distance=max_distance,
+                    visible=hexutil.CompactFov(light, max_distance)) for light in self.lights]
+                fov = fov & functools.reduce(operator.or_, light_fovs)
+                light_fov = fov
+            elif self.lights:
                 light_fov = {}
                 for light in self.lights:
                     light.field_of_view(transparent=self.is_transparent, max_distance=max_distance, visible=light_fov)
@@ -225,6 +244,179 @@ class TestFov(unittest.TestCase):
     def test_fov2(self):
         self.assertEqual(testmap2.get_map(10), testmap2_out)
 
+class TestArrayMap(unittest.TestCase):
+    def test_indexing(self):
+        amap = hexutil.ArrayMap(3, 2)
+        amap[hexutil.Hex(5, 1)] = 1
+        self.assertEqual(amap.data, bytearray([0, 0, 0, 0, 0, 1]))
+        self.assertTrue(amap(hexutil.Hex(5, 1)))
+        self.assertEqual(amap[hexutil.Hex(-1, 1)], 0)
+        self.assertEqual(len(set(amap.hexagons())), 6)
+        self.assertRaises(IndexError, amap.__setitem__, hexutil.Hex(6, 0), 1)
+
+    def test_fov(self):
+        for testmap in (testmap1, testmap2):
+            amap = testmap.array_map(testmap.is_transparent)
+            for max_distance in (3, 10):
+                self.assertEqual(amap.field_of_view(testmap.player, max_distance),
+                        testmap.player.field_of_view(testmap.is_transparent, max_distance))
+
+    def test_warm_up_fov(self):
+        hexutil.warm_up_fov(7)
+        self.assertGreaterEqual(hexutil._fov_table_cache[0], 7)
+        amap = testmap1.array_map(testmap1.is_transparent)
+        self.assertEqual(amap.field_of_view(testmap1.player, 7), testmap1.field_of_view(7))
+
+    def test_fov_smaller_radius(self):
+        # a walk for a small radius uses the table built for a larger one
+        hexutil.warm_up_fov(12)
+        amap = random_map(15, 15, 0.8, 9)
+        origin = hexutil.Hex(14, 8)
+        for max_distance in (0, 1, 4, 12):
+            expected = origin.field_of_view(amap, max_distance)
+            self.assertEqual(amap.field_of_view(origin, max_distance), expected)
+            fov = amap.field_of_view(origin, max_distance, visible=hexutil.CompactFov(origin, max_distance))
+            self.assertEqual(dict(fov.items()), expected)
+
+    def test_fov_many(self):
+        amap = testmap2.array_map(testmap2.is_transparent)
+        origins = [testmap2.player] + testmap2.lights
+        expected = [origin.field_of_view(testmap2.is_transparent, 10) for origin in origins]
+        self.assertEqual(amap.field_of_view_many(origins, 10), expected)
+        with ThreadPoolExecutor(2) as executor:
+            self.assertEqual(amap.field_of_view_many(origins, 10, executor=executor), expected)
+
+    def test_fov_many_processes(self):
+        amap = random_map(20, 20, 0.8, 5)
+        origins = list(amap.hexagons())[::7]
+        expected = amap.field_of_view_many(origins, 6)
+        expected_compact = [dict(fov.items()) for fov in amap.field_of_view_many(origins, 6, compact=True)]
+        self.assertEqual(expected_compact, expected)
+        with ProcessPoolExecutor(2) as executor:
+            self.assertEqual(amap.field_of_view_many(origins, 6, executor=executor, batches=2), expected)
+            fovs = amap.field_of_view_many(origins, 6, executor=executor, compact=True, batches=5)
+            self.assertEqual([dict(fov.items()) for fov in fovs], expected)
+            for batches in (0, -1):
+                self.assertRaises(ValueError, amap.field_of_view_many, origins, 6, executor=executor, batches=batches)
+
+class TestCompactFov(unittest.TestCase):
+    def test_indexing(self):
+        fov = hexutil.CompactFov(hexutil.Hex(4, 2), 2)
+        self.assertEqual(len(fov.data), 19)
+        indices = sorted(fov.index(hexagon) for hexagon in hexutil.ArrayMap(5, 5).hexagons()
+                if hexagon.distance(hexutil.Hex(4, 2)) <= 2)
+        self.assertEqual(indices, list(range(19)))
+        self.assertIsNone(fov.index(hexutil.Hex(8, 0)))
+        self.assertRaises(IndexError, fov.__setitem__, hexutil.Hex(8, 0), 1)
+        self.assertRaises(KeyError, fov.__getitem__, hexutil.Hex(3, 1))
+
+    def test_fov(self):
+        player = testmap2.player
+        expected = testmap2.field_of_view(10)
+        amap = testmap2.array_map(testmap2.is_transparent)
+        fovs = [
+                player.field_of_view(testmap2.is_transparent, 10, visible=hexutil.CompactFov(player, 10)),
+                amap.field_of_view(player, 10, visible=hexutil.CompactFov(player, 10)),
+                amap.field_of_view(player, 10, visible=hexutil.CompactFov(player, 12)),
+                amap.field_of_view_many([player], 10, compact=True)[0]
+                ]
+        for fov in fovs:
+            self.assertEqual(dict(fov.items()), expected)
+            self.assertEqual(len(fov), len(expected))
+            for hexagon, bitmask in expected.items():
+                self.assertIn(hexagon, fov)
+                self.assertEqual(fov[hexagon], bitmask)
+
+    def test_combine(self):
+        amap = testmap2.array_map(testmap2.is_transparent)
+        origins = [testmap2.player, testmap2.lights[0], testmap2.player]
+        radii = [10, 4, 3]
+        dicts = [amap.field_of_view(origin, radius) for origin, radius in zip(origins, radii)]
+        compacts = [amap.field_of_view(origin, radius, visible=hexutil.CompactFov(origin, radius))
+                for origin, radius in zip(origins, radii)]
+        for i in range(3):
+            for j in range(3):
+                fov1, fov2 = dicts[i], dicts[j]
+                both = {pos: fov1[pos] & fov2[pos] for pos in fov1 if fov1[pos] & fov2.get(pos, 0)}
+                either = dict(fov1)
+                for pos, bitmask in fov2.items():
+                    either[pos] = either.get(pos, 0) | bitmask
+                self.assertEqual(dict((compacts[i] & compacts[j]).items()), both)
+                self.assertEqual(dict((compacts[i] | compacts[j]).items()), either)
+
+    def test_map(self):
+        self.assertEqual(testmap2.get_map(10, compact=True), testmap2_out)
+
+class TestLightMap(unittest.TestCase):
+    def expected(self, amap, lights):
+        # per side intensity, computed from scratch with Hex.field_of_view
+        result = {}
+        for position, radius, intensity in lights:
+            for hexagon, mask in position.field_of_view(amap, radius).items():
+                value = intensity * hexutil.linear_falloff(position.distance(hexagon), radius)
+                for side in range(6):
+                    if mask & (1 << side):
+                        result[hexagon, side] = result.get((hexagon, side), 0.0) + value
+        return result
+
+    def check(self, lightmap, lights):
+        amap = lightmap.transparent
+        expected = self.expected(amap, lights)
+        intensities = lightmap.intensities()
+        for hexagon in amap.hexagons():
+            for side in range(6):
+                self.assertAlmostEqual(lightmap.intensity(hexagon, 1 << side), expected.get((hexagon, side), 0.0))
+            self.assertAlmostEqual(intensities[amap.index(hexagon)],
+                    max(expected.get((hexagon, side), 0.0) for side in range(6)))
+
+    def test_lights(self):
+        amap = testmap2.array_map(testmap2.is_transparent)
+        lightmap = hexutil.LightMap(amap)
+        lights = [(testmap2.lights[0], 5, 1.0), (testmap2.player, 3, 0.5)]
+        ids = [lightmap.add_light(*light) for light in lights]
+        self.check(lightmap, lights)
+
+        lightmap.move_light(ids[1], hexutil.Hex(5, 9))
+        lights[1] = (hexutil.Hex(5, 9), 3, 0.5)
+        self.check(lightmap, lights)
+
+        wall = hexutil.Hex(13, 3)
+        self.assertEqual(lightmap.intensity(hexutil.Hex(15, 3)), 0.0)
+        lightmap.set_transparent(wall, 1)
+        self.assertGreater(lightmap.intensity(hexutil.Hex(15, 3)), 0.0)
+        self.check(lightmap, lights)
+
+        lightmap.remove_light(ids[0])
+        self.check(lightmap, lights[1:])
+
+    def test_all_removed(self):
+        amap = hexutil.ArrayMap(20, 20, b"\x01" * 400)
+        lightmap = hexutil.LightMap(amap)
+        rng = random.Random(11)
+        hexagons = list(amap.hexagons())
+        ids = [lightmap.add_light(rng.choice(hexagons), 8, 0.7), lightmap.add_light(rng.choice(hexagons), 5, 1.3)]
+        for i in range(200):
+            lightmap.move_light(rng.choice(ids), rng.choice(hexagons))
+            lightmap.update()
+        for light_id in ids:
+            lightmap.remove_light(light_id)
+        self.assertEqual(set(lightmap.intensities()), {0.0})
+        self.assertEqual(set(lightmap.light), {0.0})
+
+    def test_incremental(self):
+        amap = random_map(20, 20, 0.7, 1)
+        lightmap = hexutil.LightMap(amap)
+        lights = [(hexutil.Hex(4, 4), 6, 1.0), (hexutil.Hex(30, 16), 6, 2.0)]
+        for light in lights:
+            lightmap.add_light(*light)
+        lightmap.update()
+        far_fov = lightmap._lights[1].fov
+        lightmap.set_transparent(hexutil.Hex(2, 4), 1 - amap[hexutil.Hex(2, 4)])
+        self.assertEqual(lightmap._dirty, {0})
+        lightmap.update()
+        self.assertIs(lightmap._lights[1].fov, far_fov)
+        self.check(lightmap, lights)
+
 class TestPathFinding(unittest.TestCase):
     def test_path1(self):
         path = frozenset(testmap1.player.find_path(testmap1.target, testmap1.is_passable)[:-1])
@@ -234,5 +426,216 @@ class TestPathFinding(unittest.TestCase):
         path = frozenset(testmap2.player.find_path(testmap2.target, testmap2.is_passable)[:-1])
         self.assertEqual(testmap2.get_map(path=path), testmap2.source)
 
+class TestAsync(unittest.TestCase):
+    def test_find_path(self):
+        expected = testmap1.player.find_path(testmap1.target, testmap1.is_passable)
+        path = asyncio.run(hexutil.aio.find_path(testmap1.player, testmap1.target, testmap1.is_passable, steps=3))
+        self.assertEqual(path, expected)
+        with ThreadPoolExecutor(1) as executor:
+            path = asyncio.run(hexutil.aio.find_path(testmap1.player, testmap1.target, testmap1.is_passable,
+                steps=3, executor=executor))
+        self.assertEqual(path, expected)
+
+    def test_find_path_options(self):
+        amap = testmap1.array_map(testmap1.is_passable)
+        expected = testmap1.player.find_path(testmap1.target, amap)
+        path = asyncio.run(hexutil.aio.find_path(testmap1.player, testmap1.target, amap,
+            workspace=hexutil.PathFinderWorkspace(amap.width, amap.height), epsilon=1.5,
+            regions=hexutil.RegionIndex(amap)))
+        self.assertEqual(path[0], expected[0])
+        self.assertEqual(path[-1], expected[-1])
+        self.assertLessEqual(len(path), 1.5 * len(expected))
+        # unreachable according to regions, so no steps are taken
+        path = asyncio.run(hexutil.aio.find_path(testmap1.player, hexutil.Hex(3, 3), amap,
+            regions=hexutil.RegionIndex(amap), steps=0))
+        self.assertIsNone(path)
+
+    def test_cancel(self):
+        # destination is unreachable on an infinite map, so this search never ends
+        destination = hexutil.Hex(10, 0)
+        async def search():
+            task = asyncio.ensure_future(hexutil.aio.find_path(hexutil.origin, destination,
+                lambda pos: pos != destination))
+            for i in range(3):
+                await asyncio.sleep(0)
+            task.cancel()
+            await task
+        self.assertRaises(asyncio.CancelledError, asyncio.run, search())
+
+    def test_fov(self):
+        expected = testmap2.field_of_view(10)
+        fov = asyncio.run(hexutil.aio.field_of_view(testmap2.player, testmap2.is_transparent, 10))
+        self.assertEqual(fov, expected)
+
+def random_map(width, height, density, seed):
+    rng = random.Random(seed)
+    return hexutil.ArrayMap(width, height, bytes(rng.random() < density for i in range(width * height)))
+
+def path_cost(path, cost):
+    return sum(cost(pos) for pos in path[1:])
+
+class TestWeightedPathFinding(unittest.TestCase):
+    start = hexutil.Hex(0, 0)
+    destination = hexutil.Hex(58, 28)
+
+    def setUp(self):
+        self.map = random_map(30, 30, 0.7, 42)
+        self.map[self.start] = self.map[self.destination] = 1
+        self.cost = lambda pos: 1 + (pos.x * pos.y) % 3
+
+    def optimal_cost(self):
+        path = self.start.find_path(self.destination, self.map, self.cost)
+        self.assertIsNotNone(path)
+        return path_cost(path, self.cost)
+
+    def check_path(self, path):
+        self.assertEqual(path[0], self.start)
+        self.assertEqual(path[-1], self.destination)
+        for pos1, pos2 in zip(path, path[1:]):
+            self.assertEqual(pos1.distance(pos2), 1)
+            self.assertTrue(self.map(pos2))
+
+    def test_weighted(self):
+        optimal_cost = self.optimal_cost()
+        for workspace in (None, hexutil.PathFinderWorkspace(30, 30)):
+            path = self.start.find_path(self.destination, self.map, self.cost, workspace, epsilon=2.0)
+            self.check_path(path)
+            self.assertLessEqual(path_cost(path, self.cost), 2.0 * optimal_cost)
+        self.assertRaises(ValueError, hexutil.HexPathFinder, self.start, self.destination, self.map, epsilon=0.5)
+
+    def test_anytime(self):
+        optimal_cost = self.optimal_cost()
+        for workspace in (None, hexutil.PathFinderWorkspace(30, 30)):
+            pathfinder = hexutil.HexPathFinder(self.start, self.destination, self.map, self.cost, workspace,
+                    epsilon=3.0, anytime=True)
+            costs = []
+            while not pathfinder.done:
+                pathfinder.run_n(10)
+                if pathfinder.found:
+                    self.check_path(pathfinder.path)
+                    self.assertEqual(path_cost(pathfinder.path, self.cost), pathfinder.path_cost)
+                    costs.append(pathfinder.path_cost)
+            self.assertEqual(pathfinder.epsilon, 1.0)
+            self.assertEqual(costs, sorted(costs, reverse=True))
+            self.assertEqual(pathfinder.path_cost, optimal_cost)
+
+    def test_anytime_unreachable(self):
+        self.map[self.destination] = 0
+        pathfinder = hexutil.HexPathFinder(self.start, self.destination, self.map, epsilon=2.0, anytime=True)
+        pathfinder.run()
+        self.assertFalse(pathfinder.found)
+        self.assertIsNone(pathfinder.path)
+
+class TestRegionIndex(unittest.TestCase):
+    def partition(self, regions):
+        result = {}
+        for hexagon in regions.passable.hexagons():
+            region = regions.region(hexagon)
+            if region:
+                result.setdefault(region, set()).add(hexagon)
+        return set(frozenset(hexagons) for hexagons in result.values())
+
+    def test_labels(self):
+        amap = testmap2.array_map(testmap2.is_passable)
+        regions = hexutil.RegionIndex(amap)
+        self.assertTrue(regions.connected(testmap2.player, testmap2.target))
+        self.assertTrue(regions.connected(testmap2.player, testmap2.lights[0]))
+        self.assertTrue(regions.connected(hexutil.Hex(3, 3), hexutil.Hex(4, 4)))
+        self.assertFalse(regions.connected(testmap2.player, hexutil.Hex(3, 3)))
+        self.assertFalse(regions.connected(testmap2.player, hexutil.Hex(1, 1)))
+        self.assertEqual(regions.region(hexutil.Hex(-2, 0)), 0)
+
+    def test_incremental(self):
+        rng = random.Random(7)
+        amap = random_map(12, 12, 0.6, 3)
+        regions = hexutil.RegionIndex(amap)
+        hexagons = list(amap.hexagons())
+        for i in range(2000):
+            regions.set_passable(rng.choice(hexagons), rng.random() < 0.6)
+            self.assertLessEqual(len(regions._parent), regions._compact_limit)
+            if i % 25 == 0:
+                self.assertEqual(self.partition(regions), self.partition(hexutil.RegionIndex(amap)))
+        self.assertEqual(self.partition(regions), self.partition(hexutil.RegionIndex(amap)))
+
+    def test_split(self):
+        amap = hexutil.ArrayMap(5, 1, b"\x01\x01\x01\x01\x01")
+        regions = hexutil.RegionIndex(amap)
+        self.assertTrue(regions.connected(hexutil.Hex(0, 0), hexutil.Hex(8, 0)))
+        regions.set_passable(hexutil.Hex(4, 0), 0)
+        self.assertFalse(regions.connected(hexutil.Hex(0, 0), hexutil.Hex(8, 0)))
+        self.assertTrue(regions.connected(hexutil.Hex(0, 0), hexutil.Hex(2, 0)))
+        self.assertTrue(regions.connected(hexutil.Hex(6, 0), hexutil.Hex(8, 0)))
+        regions.set_passable(hexutil.Hex(4, 0), 1)
+        self.assertTrue(regions.connected(hexutil.Hex(0, 0), hexutil.Hex(8, 0)))
+
+    def test_find_path(self):
+        amap = testmap1.array_map(testmap1.is_passable)
+        regions = hexutil.RegionIndex(amap)
+        expected = testmap1.player.find_path(testmap1.target, amap)
+        self.assertEqual(testmap1.player.find_path(testmap1.target, amap, regions=regions), expected)
+        unreachable = hexutil.Hex(3, 3)
+        self.assertTrue(amap(unreachable))
+        pathfinder = hexutil.HexPathFinder(testmap1.player, unreachable, amap, regions=regions)
+        self.assertTrue(pathfinder.done)
+        self.assertIsNone(testmap1.player.find_path(unreachable, amap, regions=regions))
+        # the start need not be passable
+        regions.set_passable(testmap1.player, 0)
+        self.assertTrue(regions.reachable(testmap1.player, testmap1.target))
+        self.assertEqual(testmap1.player.find_path(testmap1.target, amap, regions=regions), expected)
+
+class TestPathFinderWorkspace(unittest.TestCase):
+    def test_reuse(self):
+        workspace = hexutil.PathFinderWorkspace(10, 11)
+        for testmap in (testmap1, testmap2, testmap1):
+            expected = testmap.player.find_path(testmap.target, testmap.is_passable)
+            path = testmap.player.find_path(testmap.target, testmap.is_passable, workspace=workspace)
+            self.assertEqual(path, expected)
+        path = testmap1.player.find_path(testmap1.player, testmap1.is_passable, workspace=workspace)
+        self.assertEqual(path, [testmap1.player])
+
+    def test_outside(self):
+        workspace = hexutil.PathFinderWorkspace(10, 11)
+        outside = hexutil.Hex(-1, 1)
+        amap = hexutil.ArrayMap(10, 11, b"\x01" * 110)
+        expected = outside.find_path(hexutil.Hex(4, 2), amap)
+        self.assertEqual(len(expected), 4)
+        path = outside.find_path(hexutil.Hex(4, 2), amap, workspace=workspace)
+        self.assertEqual((path[0], path[-1], len(path)), (expected[0], expected[-1], len(expected)))
+        self.assertEqual(outside.find_path(outside, amap, workspace=workspace), [outside])
+        self.assertIsNone(hexutil.origin.find_path(hexutil.Hex(-2, 0), lambda pos: True, workspace=workspace))
+        self.assertEqual(len(hexutil.origin.find_path(hexutil.Hex(6, 4), lambda pos: True, workspace=workspace)), 6)
+
+    def test_run_n_when_done(self):
+        workspace = hexutil.PathFinderWorkspace(10, 11)
+        pathfinder = hexutil.HexPathFinder(testmap1.player, testmap1.target, testmap1.is_passable, workspace=workspace)
+        pathfinder.run()
+        path = pathfinder.path
+        # a finished pathfinder must not touch the workspace, which is now used by another one
+        other = hexutil.HexPathFinder(testmap2.player, testmap2.target, testmap2.is_passable, workspace=workspace)
+        openset = list(workspace.openset)
+        pathfinder.run_n(10)
+        self.assertEqual(pathfinder.path, path)
+        self.assertEqual(workspace.openset, openset)
+        other.run()
+        self.assertEqual(other.path, testmap2.player.find_path(testmap2.target, testmap2.is_passable))
+
+    def test_generation_wraparound(self):
+        workspace = hexutil.PathFinderWorkspace(10, 11)
+        workspace.generation = workspace._max_generation
+        testmap1.player.find_path(testmap1.target, testmap1.is_passable, workspace=workspace)
+        expected = testmap2.player.find_path(testmap2.target, testmap2.is_passable)
+        path = testmap2.player.find_path(testmap2.target, testmap2.is_passable, workspace=workspace)
+        self.assertEqual(path, expected)
+
+    def test_pool(self):
+        pool = hexutil.PathFinderWorkspacePool(10, 11)
+        testmaps = [testmap1, testmap2] * 10
+        expected = [testmap.player.find_path(testmap.target, testmap.is_passable) for testmap in testmaps]
+        with ThreadPoolExecutor(4) as executor:
+            paths = list(executor.map(
+                lambda testmap: pool.find_path(testmap.player, testmap.target, testmap.is_passable),
+                testmaps))
+        self.assertEqual(paths, expected)
+
 if __name__ == '__main__':
     unittest.main()